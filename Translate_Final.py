@@ -3,51 +3,78 @@
 # ─────────────────────────────────────────────────────────────────────────────
 
 # ────────────────────────── Standard library ──────────────────────────────────
-import io, os, sys, json, csv, re, tempfile, contextlib, warnings
+import os, sys, json, csv, re, math, gzip, time, asyncio, hashlib, tempfile, threading, contextlib, warnings
+import importlib.util, multiprocessing
+from types import MappingProxyType
+from urllib.parse import urlencode
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing  import List, Tuple, Optional, Any
+from typing  import List, Tuple, Optional, Any, Callable, TYPE_CHECKING
 
 # ────────────────────────── Third-party basics ────────────────────────────────
 import streamlit as st
 
 # ────────────────────────── TEMP PATCH for charset_normalizer ↑ pdfminer SIX ──
-# Newer `charset-normalizer >= 4.0` removed `is_cjk_uncommon`; some releases of
-# pdfminer.six (pulled in by pdfplumber) still import it. We stub it in once
-# so the import chain succeeds even with the latest charset-normalizer.
-try:
-    import charset_normalizer.utils as _cnu
-    if not hasattr(_cnu, "is_cjk_uncommon"):
-        def _dummy_is_cjk_uncommon(cp: int) -> bool:
-            """
-            Return False for every code-point.
-            Stub for pdfminer.six compatibility with newer charset-normalizer.
-            """
-            return False
-        _cnu.is_cjk_uncommon = _dummy_is_cjk_uncommon
-except Exception:
-    # If charset_normalizer itself is missing, pdfplumber will raise later and
-    # we’ll surface that error; no further action needed here.
-    pass
-
-# ────────────────────────── PDF text extraction (pdfplumber) ──────────────────
-_PDFPLUMBER_AVAILABLE = False
-_PDFPLUMBER_ERR       = ""
-try:
-    import pdfplumber  # pulls in pdfminer.six -> charset_normalizer
-    _PDFPLUMBER_AVAILABLE = True
-except Exception as ex:  # catch *all* import problems
-    _PDFPLUMBER_ERR = repr(ex)
+# pdf_extract applies the charset_normalizer stub on import (it has to run in
+# extraction worker processes too), so it is in place before pdfplumber loads.
+import pdf_extract
 
-# ────────────────────────── OpenAI ≥ 1.0 client (o3-mini) ─────────────────────
-try:
-    from openai import OpenAI
-    _OPENAI_AVAILABLE = True
-except ImportError:
-    _OPENAI_AVAILABLE = False
+# ────────────────────────── Precompiled Markdown patterns ────────────────────
+_PAGE_SPLIT_RE = re.compile(r"(?=^## Page )", re.M)   # before each page heading
+_PARA_SPLIT_RE = re.compile(r"\n\s*\n")               # blank-line paragraph gaps
+_BLANK_RUN_RE  = re.compile(r"\n(?:[ \t]*\n){2,}")    # 2+ consecutive blank lines
+
+def _tidy_markdown(md: str) -> str:
+    """
+    Collapse runs of blank lines left by joining translated chunks — one pass
+    over the whole document instead of stripping every chunk.
+    """
+    return _BLANK_RUN_RE.sub("\n\n", md).strip()
+
+# ────────────────────────── Lazily imported heavy dependencies ───────────────
+# openai, requests and the embedding stack are imported inside the helpers
+# that need them (pdfplumber and pypdfium2 likewise, inside pdf_extract), so
+# a cold start only pays for what the session actually uses. Here we just
+# check they are installed.
+def _installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+if TYPE_CHECKING:
+    import diskcache
+    import requests
+    from openai import OpenAI, AsyncOpenAI
+    from sentence_transformers import SentenceTransformer
+
+_OPENAI_AVAILABLE     = _installed("openai")
+
+# ────────────────────────── Persistent translation cache (diskcache) ──────────
+# Optional: without diskcache we still have Streamlit's in-process cache_data.
+@st.cache_resource(show_spinner=False)
+def _disk_cache() -> Optional["diskcache.Cache"]:
+    """
+    Shared on-disk cache, opened once per server process — a module-level
+    Cache would reopen its SQLite connection on every Streamlit rerun.
+    """
+    try:
+        import diskcache
+        return diskcache.Cache(os.path.expanduser("~/.cache/pdftr"))
+    except Exception:
+        return None
+
+# ────────────────────────── Semantic translation cache (embeddings) ─────────
+# Optional: catches near-duplicate chunks (e.g. a re-uploaded, lightly revised
+# PDF) that the exact-hash cache above misses.
+_SEMANTIC_CACHE_AVAILABLE = all(
+    map(_installed, ("numpy", "faiss", "sentence_transformers"))
+)
 
 # ────────────────────────── DeepL simple REST helper ──────────────────────────
-import requests
-DEEPL_SUPPORTED_LANGS = {
+try:
+    import orjson  # ~3× faster than stdlib json on large translation payloads
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+DEEPL_SUPPORTED_LANGS = MappingProxyType({
     "BG":"Bulgarian","CS":"Czech","DA":"Danish","DE":"German","EL":"Greek",
     "EN":"English","ES":"Spanish","ET":"Estonian","FI":"Finnish","FR":"French",
     "HU":"Hungarian","ID":"Indonesian","IT":"Italian","JA":"Japanese",
@@ -55,8 +82,10 @@ DEEPL_SUPPORTED_LANGS = {
     "NL":"Dutch","PL":"Polish","PT":"Portuguese","RO":"Romanian","RU":"Russian",
     "SK":"Slovak","SL":"Slovenian","SV":"Swedish","TR":"Turkish",
     "UK":"Ukrainian","ZH":"Chinese"
-}
-LANG_NAME_TO_CODE = {v:k for k,v in DEEPL_SUPPORTED_LANGS.items()}
+})
+LANG_NAME_TO_CODE = MappingProxyType({v:k for k,v in DEEPL_SUPPORTED_LANGS.items()})
+# Target-language dropdown options, sorted once instead of on every rerun.
+_LANG_OPTIONS = ("English",) + tuple(sorted(LANG_NAME_TO_CODE))
 
 # ────────────────────────── Streamlit page config ─────────────────────────────
 st.set_page_config(
@@ -108,34 +137,750 @@ with st.sidebar:
     st.warning("AI output may contain errors. Verify critical data.")
 
 # ────────────────────────── OpenAI client -------------------------------------
-openai_client = (
-    OpenAI(api_key=st.session_state.OPENAI_API_KEY)
-    if _OPENAI_AVAILABLE and st.session_state.OPENAI_API_KEY else None
-)
+def _openai_client(key: str) -> "OpenAI":
+    """
+    Sync OpenAI client, built once per session (and per key) and kept in
+    session state so reruns skip the import and construction.
+    """
+    client = st.session_state.get("_openai_client")
+    if client is None or client.api_key != key:
+        from openai import OpenAI
+        client = st.session_state["_openai_client"] = OpenAI(api_key=key)
+    return client
 
 # ────────────────────────── Helper function: PDF → Markdown -------------------
-def pdf_to_markdown(pdf_bytes: bytes) -> str:
+# Upper bound on extraction processes; pdfminer parsing is CPU-bound, so
+# beyond a handful of cores the extra processes mostly cost memory.
+_get_max_workers = lambda: min(os.cpu_count() or 1, 8)
+# Below this many pages, pool start-up costs more than it saves.
+_POOL_MIN_PAGES  = 16
+
+def _pool_context() -> Optional[multiprocessing.context.BaseContext]:
+    """
+    Start method for the extraction pool, or None to extract in-process.
+    Only fork is used: spawn/forkserver children re-run `__main__` from its
+    path, which under Streamlit is this whole app script. A forked child
+    holds only the forking thread and just runs pdf_extract on the bytes.
+    """
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+def _extract_markdown(pdf_bytes: bytes) -> str:
+    """
+    Parse all pages — in parallel across a process pool for larger PDFs —
+    and format them as Markdown. Raises on any parsing error.
+    """
+    n_pages = pdf_extract.page_count(pdf_bytes)
+    texts   = [""] * n_pages  # slot per page; filled as blocks come back
+    ctx     = _pool_context()
+    if n_pages < _POOL_MIN_PAGES or ctx is None:
+        for i, text in pdf_extract.extract_block(pdf_bytes, list(range(n_pages))):
+            texts[i - 1] = text
+    else:
+        workers    = _get_max_workers()
+        # ~4 blocks per worker keeps the pool balanced without reopening the
+        # PDF for every single page.
+        block_size = max(1, math.ceil(n_pages / (4 * workers)))
+        blocks     = [
+            list(range(start, min(start + block_size, n_pages)))
+            for start in range(0, n_pages, block_size)
+        ]
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=ctx,
+            initializer=pdf_extract.init_worker, initargs=(pdf_bytes,)
+        ) as executor:
+            # With fork, the pool starts every worker on the first submit,
+            # and map() submits everything up front; hold the PDFium lock
+            # across it so no other session's thread is inside PDFium when
+            # the children are forked.
+            with pdf_extract.PDFIUM_LOCK:
+                results = executor.map(pdf_extract.extract_worker_block, blocks)
+            for block in results:
+                for i, text in block:
+                    texts[i - 1] = text
+    # str.join materializes the generator into a list first, so the formatted
+    # pages are held once in that list and once in the joined result.
+    return "\n\n".join(
+        f"## Page {i}\n\n{text.strip()}" for i, text in enumerate(texts, 1)
+    )
+
+@st.cache_data(show_spinner=False)
+def _cached_markdown(pdf_sha256: str, _pdf_bytes: bytes) -> str:
+    """
+    Memoize extraction on the PDF's sha256 (the leading underscore keeps
+    Streamlit from re-hashing the raw bytes), backed by the disk cache so
+    results survive restarts. Exceptions propagate and are never cached.
+    """
+    ckey = f"pdf-md:{pdf_extract.EXTRACTOR_TAG}:{pdf_sha256}"
+    cache = _disk_cache()
+    if cache is not None and ckey in cache:
+        return cache[ckey]
+    md = _extract_markdown(_pdf_bytes)
+    if cache is not None:
+        cache[ckey] = md
+    return md
+
+def pdf_to_markdown(pdf_bytes: bytes, pdf_sha256: Optional[str] = None) -> str:
     """
     Extract text from each page of a PDF, returning structured Markdown.
+    Results are cached on `pdf_sha256` (computed here if not supplied).
     """
-    if not _PDFPLUMBER_AVAILABLE:
+    if not (pdf_extract.PDFIUM_AVAILABLE or pdf_extract.PDFPLUMBER_AVAILABLE):
+        st.error("No PDF text extractor installed — add `pypdfium2` or `pdfplumber`.")
+        return ""
+    try:
+        pdf_sha256 = pdf_sha256 or hashlib.sha256(pdf_bytes).hexdigest()
+        return _cached_markdown(pdf_sha256, pdf_bytes)
+    except pdf_extract.PdfplumberImportError as ex:
         st.error(
             "pdfplumber import failed.\n\n"
-            f"```python\n{_PDFPLUMBER_ERR}\n```"
+            f"```python\n{ex}\n```"
         )
         return ""
-    try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            pages_md = []
-            for i, p in enumerate(pdf.pages, 1):
-                text = p.extract_text() or ""
-                page_md = f"## Page {i}\n\n{text.strip()}"
-                pages_md.append(page_md)
-        return "\n\n".join(pages_md)
     except Exception as ex:
         st.error(f"PDF parsing failed:\n\n```\n{ex}\n```")
         return ""
 
+# ────────────────────────── Helper functions: translation (cached) ------------
+def _translation_cache_key(src_md: str, target: str, provider: str) -> str:
+    """
+    Disk-cache key for one translation; API keys are deliberately excluded so
+    a cached result survives key rotation.
+    """
+    return hashlib.sha256(f"{src_md}|{target}|{provider}".encode()).hexdigest()
+
+def _key_namespace(key: str) -> str:
+    """
+    Short, non-reversible tag for an API key, used to scope shared on-disk
+    state (semantic stores, pending batches) to whoever owns the key.
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+# Near-duplicate threshold (cosine similarity of normalized embeddings). A
+# hit additionally needs every number in the unit body to match exactly and
+# a similar body length. The nearest few neighbours are tried in turn, since
+# pages differing only in their values embed almost identically.
+_SEM_MIN_SCORE     = 0.92
+_SEM_MAX_LEN_RATIO = 1.1
+_SEM_TOP_K         = 5
+# Rows per store; bounds both memory and the full rewrite after each miss.
+_SEM_MAX_ROWS      = 5_000
+_SEM_CACHE_DIR     = Path(os.path.expanduser("~/.cache/pdftr"))
+_NUM_TOKEN_RE      = re.compile(r"\d+(?:[.,]\d+)*")
+
+@st.cache_resource(show_spinner=False)
+def _semantic_model() -> "SentenceTransformer":
+    """
+    Sentence-embedding model, loaded once per server process.
+    """
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer("all-MiniLM-L6-v2", device="cpu")
+
+@st.cache_resource(show_spinner=False)
+def _semantic_store(namespace: str, target: str) -> dict:
+    """
+    Store for one API key (`namespace`, a hash of it) and target language: a
+    faiss inner-product index over normalized body embeddings plus parallel
+    rows holding the translation and what a hit must match. Scoping by key
+    keeps one user's documents from being served to another; no source text
+    is kept. Persisted owner-only under the cache dir; a pair of files that
+    is unreadable or out of step is discarded and the store starts empty.
+    """
+    import faiss
+    import numpy as np
+    stem       = f"sem-{namespace}-{target}"
+    index_path = _SEM_CACHE_DIR / f"{stem}.faiss"
+    rows_path  = _SEM_CACHE_DIR / f"{stem}.json"
+    index = rows = None
+    if index_path.exists() and rows_path.exists():
+        try:
+            raw     = index_path.read_bytes()
+            payload = json.loads(rows_path.read_text(encoding="utf-8"))
+            if payload["index_sha256"] == hashlib.sha256(raw).hexdigest():
+                index = faiss.deserialize_index(np.frombuffer(raw, dtype=np.uint8))
+                rows  = payload["rows"]
+        except (RuntimeError, OSError, ValueError, KeyError, TypeError):
+            index = rows = None
+        if index is not None and index.ntotal != len(rows):
+            index = rows = None
+    if index is None:
+        dim   = _semantic_model().get_sentence_embedding_dimension()
+        index = faiss.IndexFlatIP(dim)
+        rows  = []
+    return {"index": index, "rows": rows, "lock": threading.Lock(),
+            "index_path": index_path, "rows_path": rows_path,
+            "stats": {"hits": 0, "misses": 0}}
+
+def _split_heading(md: str) -> Tuple[str, str]:
+    """
+    Split a leading Markdown heading line ("## Page 3") from the body.
+    """
+    first, _, rest = md.strip().partition("\n")
+    if first.startswith("#"):
+        return first.strip(), rest.strip()
+    return "", md.strip()
+
+def _rebuild_heading(src_head: str, row: dict) -> Optional[str]:
+    """
+    Translated heading for `src_head` from a cached row: the cached
+    translated heading with its numbers swapped for this chunk's (so
+    "## Seite 7" becomes "## Seite 3"). None when the headings differ in
+    more than their numbers.
+    """
+    if _NUM_TOKEN_RE.sub("0", src_head) != row["shape"]:
+        return None
+    if not src_head:
+        return ""
+    if _NUM_TOKEN_RE.findall(row["t_head"]) != row["head_nums"]:
+        return None
+    nums = iter(_NUM_TOKEN_RE.findall(src_head))
+    return _NUM_TOKEN_RE.sub(lambda m: next(nums), row["t_head"])
+
+def _save_semantic_store(store: dict, vecs: Any, rows: List[dict]) -> None:
+    """
+    Append rows (evicting the oldest beyond _SEM_MAX_ROWS) and persist the
+    store with owner-only permissions. Caller holds store["lock"].
+    """
+    import faiss
+    vecs, rows = vecs[-_SEM_MAX_ROWS:], rows[-_SEM_MAX_ROWS:]
+    index = store["index"]
+    drop  = max(0, index.ntotal + len(rows) - _SEM_MAX_ROWS)
+    if drop:
+        keep     = index.ntotal - drop
+        rebuilt  = faiss.IndexFlatIP(index.d)
+        if keep:
+            rebuilt.add(index.reconstruct_n(drop, keep))
+        store["index"] = index = rebuilt
+        store["rows"]  = store["rows"][drop:]
+    index.add(vecs)
+    store["rows"].extend(rows)
+
+    # Write both files beside their targets, then swap them in, so a crash
+    # or a concurrent reader never sees a half-written file. The rows record
+    # a hash of the index they belong to; a crash between the two swaps
+    # leaves a mismatched pair, which _semantic_store discards on load.
+    _SEM_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    raw     = faiss.serialize_index(index).tobytes()
+    payload = {"index_sha256": hashlib.sha256(raw).hexdigest(), "rows": store["rows"]}
+    pending = [(store["index_path"], raw),
+               (store["rows_path"], json.dumps(payload).encode("utf-8"))]
+    tmps = [path.with_name(f"{path.name}.{os.getpid()}.tmp") for path, _ in pending]
+    try:
+        for tmp, (_, data) in zip(tmps, pending):
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+        for tmp, (path, _) in zip(tmps, pending):
+            os.replace(tmp, path)
+    finally:
+        for tmp in tmps:
+            if tmp.exists():
+                tmp.unlink()
+
+def _semantic_units(chunk: str, model: "SentenceTransformer"
+                    ) -> Tuple[List[str], List[str], List[bool]]:
+    """
+    Re-split a chunk into units that fit the embedding window, so whole
+    pages can still be cached piecewise. Paragraphs are packed together;
+    an oversized paragraph is split at its line breaks; a heading always
+    stays with the text after it. Returns (units, seps, fits): seps[k] is
+    the text that preceded unit k in the chunk ("" for the first), so
+    "".join(sep + unit) rebuilds it; fits[k] is False for a unit still too
+    long to embed (a single over-long line).
+    """
+    budget = model.max_seq_length - 2  # [CLS] … [SEP]
+    def _ntok(texts: List[str]) -> List[int]:
+        if not texts:
+            return []
+        ids = model.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return [len(x) for x in ids]
+
+    paras  = [p.strip("\n") for p in _PARA_SPLIT_RE.split(chunk) if p.strip()]
+    pieces = []  # (text, separator before it, tokens)
+    for para, n in zip(paras, _ntok(paras)):
+        if n <= budget:
+            pieces.append((para, "\n\n", n))
+            continue
+        sep = "\n\n"
+        for line, m in zip(para.split("\n"), _ntok(para.split("\n"))):
+            pieces.append((line, sep, m))
+            sep = "\n"
+
+    units, seps, fits = [], [], []
+    cur, cur_tok, cur_sep = "", 0, ""
+    for text, sep, n in pieces:
+        lone_heading = cur.startswith("#") and "\n" not in cur
+        if cur and cur_tok + n > budget and not lone_heading:
+            units.append(cur); seps.append(cur_sep); fits.append(cur_tok <= budget)
+            cur, cur_tok, cur_sep = "", 0, sep
+        cur = f"{cur}{sep}{text}" if cur else text
+        cur_tok += n
+    if cur:
+        units.append(cur); seps.append(cur_sep); fits.append(cur_tok <= budget)
+    return units, seps, fits
+
+def _translate_with_semantic_cache(chunks: List[str], target: str, key: str,
+                                   translate: Callable[[List[str]], List[str]]
+                                   ) -> List[str]:
+    """
+    Serve near-duplicate text from the semantic cache and pass only the
+    misses to `translate`; new translations are added to the cache.
+    Chunks are cached (and then translated) as window-sized units from
+    _semantic_units and reassembled afterwards. Headings are embedded
+    separately from the body and re-applied on a hit. Falls through to
+    `translate(chunks)` when the optional deps are missing or no unit fits.
+    """
+    if not _SEMANTIC_CACHE_AVAILABLE or not chunks:
+        return translate(chunks)
+    import numpy as np
+
+    model  = _semantic_model()
+    units, seps, spans = [], [], []  # spans[c] = (first unit, count) of chunk c
+    fits: List[bool] = []
+    for chunk in chunks:
+        u, sp, ok = _semantic_units(chunk, model)
+        spans.append((len(units), len(u)))
+        units += u; seps += sp; fits += ok
+
+    parts    = [_split_heading(u) for u in units]
+    eligible = [i for i, (_, body) in enumerate(parts) if body and fits[i]]
+    if not eligible:
+        return translate(chunks)
+    store = _semantic_store(_key_namespace(key), target)
+    vecs  = model.encode(
+        [parts[i][1] for i in eligible],
+        normalize_embeddings=True, convert_to_numpy=True
+    ).astype(np.float32)
+
+    out: List[Optional[str]] = [None] * len(units)
+    with store["lock"]:
+        if store["index"].ntotal:
+            k = min(_SEM_TOP_K, store["index"].ntotal)
+            scores, ids = store["index"].search(vecs, k)
+            for i, cand_scores, cand_ids in zip(eligible, scores, ids):
+                head, body = parts[i]
+                nums = _NUM_TOKEN_RE.findall(body)
+                for score, row_id in zip(cand_scores, cand_ids):
+                    if row_id < 0 or score < _SEM_MIN_SCORE:
+                        break  # candidates come best-first
+                    row = store["rows"][row_id]
+                    lo, hi = sorted((row["len"], len(body)))
+                    if row["nums"] != nums or hi > _SEM_MAX_LEN_RATIO * max(1, lo):
+                        continue
+                    t_head = _rebuild_heading(head, row)
+                    if t_head is None:
+                        continue
+                    out[i] = (f"{t_head}\n\n{row['t_body']}" if t_head
+                              else row["t_body"])
+                    break
+
+    miss_idx = [i for i, t in enumerate(out) if t is None]
+    store["stats"]["hits"]   += len(units) - len(miss_idx)
+    store["stats"]["misses"] += len(miss_idx)
+    if miss_idx:
+        fresh = translate([units[i] for i in miss_idx])
+        for i, trans in zip(miss_idx, fresh):
+            out[i] = trans
+
+        missed = set(miss_idx)
+        new_rows, new_vecs = [], []
+        for pos, i in enumerate(eligible):
+            if i not in missed:
+                continue
+            head, body     = parts[i]
+            t_head, t_body = _split_heading(out[i])
+            if head and not t_head:
+                continue  # translation dropped the heading; can't re-apply it
+            new_rows.append({
+                "shape":     _NUM_TOKEN_RE.sub("0", head),
+                "head_nums": _NUM_TOKEN_RE.findall(head),
+                "nums":      _NUM_TOKEN_RE.findall(body),
+                "len":       len(body),
+                "t_head":    t_head,
+                "t_body":    t_body,
+            })
+            new_vecs.append(vecs[pos])
+        if new_rows:
+            with store["lock"]:
+                _save_semantic_store(store, np.stack(new_vecs), new_rows)
+
+    return [
+        "".join(seps[k] + out[k].strip() for k in range(start, start + count))
+        for start, count in spans
+    ]
+
+# DeepL accepts up to 50 `text` fields per request and caps bodies at 128 KiB;
+# chunks are packed into requests that stay safely under both limits, sized
+# by their URL-encoded form (1.3× the UTF-8 size for German, ~2.5× for CJK).
+# _DEEPL_CHUNK_CHARS is a hard cap, so even an all-4-byte-char chunk encodes
+# to 60 KB and always fits a request on its own.
+_DEEPL_MAX_TEXTS      = 50
+_DEEPL_MAX_BODY_BYTES = 120_000
+_DEEPL_CHUNK_CHARS    = 5_000
+# Form bodies at least this large are sent gzip-compressed (Markdown text
+# typically shrinks 4–6×); smaller ones aren't worth the CPU.
+_DEEPL_GZIP_MIN_BYTES = 1_024
+
+def _cut_paragraph(para: str, max_chars: int) -> List[str]:
+    """
+    Cut a paragraph longer than `max_chars` into pieces that fit, preferring
+    line breaks, then spaces, and only as a last resort mid-word.
+    """
+    pieces = []
+    while len(para) > max_chars:
+        cut = para.rfind("\n", 0, max_chars + 1)
+        if cut < max_chars // 2:
+            cut = para.rfind(" ", 0, max_chars + 1)
+        if cut < max_chars // 2:
+            cut = max_chars
+        pieces.append(para[:cut])
+        para = para[cut:].lstrip("\n ")
+    if para:
+        pieces.append(para)
+    return pieces
+
+def _split_markdown(src_md: str, max_chars: int) -> List[str]:
+    """
+    Split Markdown on blank lines and pack whole paragraphs into chunks of at
+    most `max_chars`. Splitting at paragraph boundaries keeps headings
+    intact; a paragraph over the cap is cut by _cut_paragraph, and those cuts
+    come back as paragraph breaks after translation.
+    """
+    chunks, cur, cur_len = [], [], 0
+    for para in _PARA_SPLIT_RE.split(src_md):
+        if not para.strip():
+            continue
+        for piece in _cut_paragraph(para, max_chars):
+            if cur and cur_len + len(piece) > max_chars:
+                chunks.append("\n\n".join(cur))
+                cur, cur_len = [], 0
+            cur.append(piece)
+            cur_len += len(piece) + 2
+    if cur:
+        chunks.append("\n\n".join(cur))
+    return chunks
+
+def _deepl_batches(chunks: List[str], fixed_fields: List[Tuple[str, str]]
+                   ) -> List[List[str]]:
+    """
+    Group chunks into per-request batches respecting DeepL's field/body caps.
+    Sizes are those of the URL-encoded form actually sent, including the
+    `fixed_fields` (target_lang etc.) repeated in every request.
+    """
+    overhead = len(urlencode(fixed_fields))
+    batches, cur, cur_bytes = [], [], overhead
+    for chunk in chunks:
+        size = 1 + len(urlencode([("text", chunk)]))  # "&" + "text=…"
+        if cur and (len(cur) >= _DEEPL_MAX_TEXTS
+                    or cur_bytes + size > _DEEPL_MAX_BODY_BYTES):
+            batches.append(cur)
+            cur, cur_bytes = [], overhead
+        cur.append(chunk)
+        cur_bytes += size
+    if cur:
+        batches.append(cur)
+    return batches
+
+@st.cache_resource(show_spinner=False)
+def _deepl_session() -> "requests.Session":
+    """
+    Shared keep-alive session for DeepL so the TLS handshake is paid once per
+    server process rather than per request. Retries transient 429/5xx
+    answers with backoff; POST is included since a translation is safe to
+    resend.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10, pool_maxsize=10,
+        max_retries=Retry(
+            total=3, backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False
+        )
+    ))
+    return session
+
+@st.cache_resource(show_spinner=False)
+def _deepl_gzip_state() -> dict:
+    """
+    Whether DeepL still gets gzip-compressed bodies. Compression isn't a
+    documented DeepL feature, so once it is refused (a 415, or a 400 that
+    the same body sent uncompressed avoids) it stays off for the rest of
+    the server process instead of costing a retry on every batch.
+    """
+    return {"enabled": True}
+
+def _deepl_translate_chunks(chunks: List[str], target_code: str, key: str) -> List[str]:
+    """
+    Translate chunks via DeepL, packing them into as few POSTs as allowed.
+    The key travels in the Authorization header, so it stays readable even
+    when the server can't inflate a compressed body.
+    """
+    session    = _deepl_session()
+    gzip_state = _deepl_gzip_state()
+    translated = []
+    fixed      = [("target_lang", target_code)]
+    for batch in _deepl_batches(chunks, fixed):
+        # Repeated `text` fields → one translation per field, in order.
+        data = fixed + [("text", chunk) for chunk in batch]
+        form    = urlencode(data).encode("utf-8")
+        gzipped = gzip_state["enabled"] and len(form) >= _DEEPL_GZIP_MIN_BYTES
+        suspect = False  # a gzipped send got a 400; the plain resend decides
+        while True:
+            headers = {"Authorization": f"DeepL-Auth-Key {key}",
+                       "Content-Type":  "application/x-www-form-urlencoded"}
+            if gzipped:
+                headers["Content-Encoding"] = "gzip"
+            with session.post(
+                "https://api-free.deepl.com/v2/translate",
+                data=gzip.compress(form) if gzipped else form,
+                headers=headers,
+                timeout=30,
+                stream=True
+            ) as resp:
+                if gzipped and resp.status_code in (400, 415):
+                    # 415 is an outright refusal of the encoding. A 400 may
+                    # just be a bad request, so resend plain and only blame
+                    # compression if that succeeds.
+                    if resp.status_code == 415:
+                        gzip_state["enabled"] = False
+                    suspect = resp.status_code == 400
+                    gzipped = False
+                    continue
+                if suspect and resp.status_code == 200:
+                    gzip_state["enabled"] = False
+                if resp.status_code != 200:
+                    raise RuntimeError(f"DeepL error {resp.status_code}: {resp.text}")
+                # decode_content: undo any gzip transfer encoding before parsing.
+                body = resp.raw.read(decode_content=True)
+            break
+        translated.extend(t["text"] for t in _json_loads(body)["translations"])
+    return translated
+
+@st.cache_data(show_spinner=False)
+def _deepl_translate(src_md: str, target_code: str, key: str) -> str:
+    """
+    Translate Markdown via the DeepL REST API.
+    Raises on any non-200 response so failures are never cached.
+    """
+    ckey = _translation_cache_key(src_md, target_code, "DeepL")
+    cache = _disk_cache()
+    if cache is not None and ckey in cache:
+        return cache[ckey]
+
+    translated = _translate_with_semantic_cache(
+        _split_markdown(src_md, _DEEPL_CHUNK_CHARS), target_code, key,
+        lambda miss: _deepl_translate_chunks(miss, target_code, key)
+    )
+    trans = _tidy_markdown("\n\n".join(translated))
+
+    if cache is not None:
+        cache[ckey] = trans
+    return trans
+
+# Max o3-mini requests in flight at once for one document.
+_O3_CONCURRENCY = 10
+
+def _o3_messages(chunk: str, target: str) -> List[dict]:
+    """
+    Chat messages asking o3-mini to translate one Markdown chunk.
+    """
+    system_msg = (
+        f"Translate the following Markdown into {target}, "
+        "preserving all headings and formatting. "
+        "Respond ONLY with the translation."
+    )
+    return [
+        {"role":"system","content":system_msg},
+        {"role":"user","content":chunk},
+    ]
+
+@st.cache_resource(show_spinner=False)
+def _async_loop() -> asyncio.AbstractEventLoop:
+    """
+    Long-lived event loop on a daemon thread. The cached async client's
+    pooled connections belong to the loop that opened them, so every request
+    must run here rather than in a fresh asyncio.run() loop.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True,
+                     name="pdftr-async").start()
+    return loop
+
+@st.cache_resource(show_spinner=False)
+def _async_openai_client(key: str) -> "AsyncOpenAI":
+    """
+    AsyncOpenAI over one shared httpx client (HTTP/2 when `h2` is installed),
+    so concurrent chunk requests multiplex over a single kept-alive
+    connection instead of each opening their own.
+    """
+    import httpx
+    from openai import AsyncOpenAI
+    http_client = httpx.AsyncClient(
+        http2=_installed("h2"),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+    )
+    return AsyncOpenAI(api_key=key, http_client=http_client)
+
+async def _o3_translate_chunks(chunks: List[str], target: str,
+                               aclient: "AsyncOpenAI") -> List[str]:
+    """
+    Translate chunks concurrently (bounded by _O3_CONCURRENCY); results are
+    returned in input order.
+    """
+    sem = asyncio.Semaphore(_O3_CONCURRENCY)
+    async def _tx(chunk: str) -> str:
+        async with sem:
+            comp = await aclient.chat.completions.create(
+                model="o3-mini",
+                messages=_o3_messages(chunk, target)
+            )
+        return comp.choices[0].message.content
+    return await asyncio.gather(*(_tx(c) for c in chunks))
+
+# Documents longer than this (chars) go through the Batch API: half the cost
+# and no per-request rate limiting, at the price of asynchronous turnaround.
+_O3_BATCH_THRESHOLD = 200_000
+_O3_BATCH_TERMINAL  = ("completed", "failed", "expired", "cancelled")
+
+def _batch_failure_summary(client: "OpenAI", batch: Any) -> str:
+    """
+    First few errors of a batch: per-request ones from its error file, else
+    batch-level ones (e.g. input validation failures).
+    """
+    if not batch.error_file_id:
+        errors = getattr(batch.errors, "data", None) or []
+        if not errors:
+            return "no error details"
+        return "; ".join(f"{e.code}: {e.message}" for e in errors[:3])
+    lines = client.files.content(batch.error_file_id).text.splitlines()
+    msgs  = []
+    for line in lines[:3]:
+        rec = json.loads(line)
+        err = rec.get("error") or (rec.get("response") or {}).get("body")
+        msgs.append(f"{rec.get('custom_id')}: {err}")
+    return "; ".join(msgs) + (" …" if len(lines) > 3 else "")
+
+def _o3_translate_batch(chunks: List[str], target: str, key: str) -> List[str]:
+    """
+    Translate chunks through the OpenAI Batch API, polling with exponential
+    backoff and showing progress; results are returned in input order.
+    The batch id is stored (disk cache, else session state) under the key's
+    namespace plus a hash of the submitted requests, so a rerun that
+    interrupts polling resumes the same paid batch instead of submitting a
+    new one. A stored batch that can no longer be resumed is replaced.
+    """
+    from openai import NotFoundError, PermissionDeniedError
+    client = _openai_client(key)
+    jsonl  = "\n".join(
+        json.dumps({
+            "custom_id": f"page-{i}",
+            "method":    "POST",
+            "url":       "/v1/chat/completions",
+            "body":      {"model": "o3-mini",
+                          "messages": _o3_messages(chunk, target)},
+        })
+        for i, chunk in enumerate(chunks)
+    )
+    pending = _disk_cache()
+    if pending is None:
+        pending = st.session_state.setdefault("_o3_pending_batches", {})
+    bkey = (f"o3-batch:{_key_namespace(key)}:"
+            f"{hashlib.sha256(jsonl.encode('utf-8')).hexdigest()}")
+
+    batch = None
+    if bkey in pending:
+        try:
+            batch = client.batches.retrieve(pending[bkey])
+        except (NotFoundError, PermissionDeniedError):
+            batch = None  # deleted, or not visible to this key/org
+        if batch is not None and batch.status in ("failed", "expired", "cancelled"):
+            batch = None  # ended while nobody was polling; start over
+    if batch is None:
+        batch_file = client.files.create(
+            file=("pdftr_batch.jsonl", jsonl.encode("utf-8")), purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        pending[bkey] = batch.id
+
+    bar   = st.progress(0.0, text="Waiting for o3-mini batch …")
+    delay = 5.0
+    while batch.status not in _O3_BATCH_TERMINAL:
+        time.sleep(delay)
+        delay = min(delay * 2, 300.0)
+        batch = client.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        if counts and counts.total:
+            done = counts.completed + counts.failed
+            bar.progress(done / counts.total,
+                         text=f"o3-mini batch: {done}/{counts.total} chunks")
+    bar.empty()
+    # Terminal either way: a later click should submit afresh.
+    del pending[bkey]
+
+    if batch.status != "completed":
+        raise RuntimeError(f"o3-mini batch {batch.id} ended with status "
+                           f"'{batch.status}': {_batch_failure_summary(client, batch)}")
+    counts = batch.request_counts
+    if (counts and counts.failed) or batch.error_file_id:
+        failed = counts.failed if counts else "some"
+        raise RuntimeError(f"o3-mini batch {batch.id}: {failed} of "
+                           f"{len(chunks)} chunks failed — "
+                           f"{_batch_failure_summary(client, batch)}")
+    if not batch.output_file_id:
+        raise RuntimeError(f"o3-mini batch {batch.id} completed without an "
+                           "output file")
+
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        rec  = json.loads(line)
+        resp = rec.get("response") or {}
+        if rec.get("error") or resp.get("status_code") != 200:
+            raise RuntimeError(f"o3-mini batch item {rec['custom_id']} failed: "
+                               f"{rec.get('error') or resp.get('body')}")
+        results[rec["custom_id"]] = resp["body"]["choices"][0]["message"]["content"]
+    missing = [f"page-{i}" for i in range(len(chunks)) if f"page-{i}" not in results]
+    if missing:
+        raise RuntimeError(f"o3-mini batch {batch.id} returned no result for "
+                           f"{len(missing)} chunk(s): {', '.join(missing[:5])}")
+    return [results[f"page-{i}"] for i in range(len(chunks))]
+
+@st.cache_data(show_spinner=False)
+def _o3_translate(src_md: str, target: str, key: str) -> str:
+    """
+    Translate Markdown via o3-mini, preserving headings and formatting.
+    Each "## Page N" section is translated as its own request — concurrently
+    for normal documents, via the Batch API for very long ones.
+    """
+    ckey = _translation_cache_key(src_md, target, "o3-mini")
+    cache = _disk_cache()
+    if cache is not None and ckey in cache:
+        return cache[ckey]
+
+    def _translate(miss: List[str]) -> List[str]:
+        if sum(map(len, miss)) > _O3_BATCH_THRESHOLD:
+            return _o3_translate_batch(miss, target, key)
+        coro = _o3_translate_chunks(miss, target, _async_openai_client(key))
+        return asyncio.run_coroutine_threadsafe(coro, _async_loop()).result()
+
+    chunks = [c for c in _PAGE_SPLIT_RE.split(src_md) if c.strip()]
+    trans  = _tidy_markdown(
+        "\n\n".join(_translate_with_semantic_cache(chunks, target, key, _translate))
+    )
+
+    if cache is not None:
+        cache[ckey] = trans
+    return trans
+
 # ────────────────────────── Main UI layout ------------------------------------
 st.title("📄 PDF → Markdown → Translate")
 st.caption("Structured Markdown extraction with optional translation")
@@ -163,7 +908,8 @@ if analyze_button:
         with analysis_container:
             st.subheader("📄 PDF → Markdown")
             pdf_bytes = uploaded_pdf.read()
-            analysis_result = pdf_to_markdown(pdf_bytes)
+            pdf_sha256 = hashlib.sha256(pdf_bytes).hexdigest()
+            analysis_result = pdf_to_markdown(pdf_bytes, pdf_sha256)
             st.markdown("### Resulting Markdown")
             st.markdown(analysis_result or "*No output*")
 
@@ -177,54 +923,35 @@ with translation_container:
     if not st.session_state.get("analysis_result"):
         st.info("Run analysis/conversion first.")
     else:
-        langs  = ["English"] + sorted(LANG_NAME_TO_CODE.keys())
-        target = st.selectbox("Target language:", langs, index=0)
+        target = st.selectbox("Target language:", _LANG_OPTIONS, index=0)
 
         if target == "English":
             st.info("Already in English — no translation needed.")
         else:
-            if translation_provider == "o3-mini" and openai_client is None:
+            if translation_provider == "o3-mini" and not (
+                _OPENAI_AVAILABLE and st.session_state.OPENAI_API_KEY
+            ):
                 st.warning("Add OpenAI key to use o3-mini translation.")
             if translation_provider == "DeepL" and not st.session_state.DEEPL_API_KEY:
                 st.warning("Add DeepL key for translation.")
 
             if st.button("Translate Markdown"):
-                src_md = st.session_state["analysis_result"]
+                # Read session state once; everything below works on locals.
+                src_md      = st.session_state["analysis_result"]
+                deepl_key   = st.session_state.DEEPL_API_KEY
+                openai_key  = st.session_state.OPENAI_API_KEY
+                target_code = LANG_NAME_TO_CODE[target]
                 with st.spinner(f"Translating via {translation_provider} …"):
                     if translation_provider == "DeepL":
                         try:
-                            resp = requests.post(
-                                "https://api-free.deepl.com/v2/translate",
-                                data={
-                                    "auth_key":    st.session_state.DEEPL_API_KEY,
-                                    "text":        src_md,
-                                    "target_lang": LANG_NAME_TO_CODE[target]
-                                },
-                                timeout=30
-                            )
-                            if resp.status_code == 200:
-                                trans = resp.json()["translations"][0]["text"]
-                                st.markdown(f"## 🌐 Translated ({target})")
-                                st.markdown(trans)
-                            else:
-                                st.error(f"DeepL error {resp.status_code}: {resp.text}")
+                            trans = _deepl_translate(src_md, target_code, deepl_key)
+                            st.markdown(f"## 🌐 Translated ({target})")
+                            st.markdown(trans)
                         except Exception as ex:
                             st.error(f"DeepL request failed:\n\n```\n{ex}\n```")
                     else:  # translation_provider == "o3-mini"
                         try:
-                            system_msg = (
-                                f"Translate the following Markdown into {target}, "
-                                "preserving all headings and formatting. "
-                                "Respond ONLY with the translation."
-                            )
-                            comp = openai_client.chat.completions.create(
-                                model="o3-mini",
-                                messages=[
-                                    {"role":"system","content":system_msg},
-                                    {"role":"user","content":src_md},
-                                ]
-                            )
-                            trans = comp.choices[0].message.content.strip()
+                            trans = _o3_translate(src_md, target, openai_key)
                             st.markdown(f"## 🌐 Translated ({target})")
                             st.markdown(trans)
                         except Exception as ex:
@@ -0,0 +1,142 @@
+# ─────────────────────────────────────────────────────────────────────────────
+#  PDF page-text extraction workers for Translate_Final.py
+# ─────────────────────────────────────────────────────────────────────────────
+# Kept out of the Streamlit script on purpose: Streamlit installs a fresh
+# `__main__` module on every rerun, so a worker defined in the script cannot
+# be pickled reliably by ProcessPoolExecutor. This module only depends on the
+# standard library at import time and is safe to load in worker processes.
+
+# ────────────────────────── Standard library ──────────────────────────────────
+import io, os, threading, importlib.util
+from typing import List, Tuple, Optional
+
+# ────────────────────────── TEMP PATCH for charset_normalizer ↑ pdfminer SIX ──
+# Newer `charset-normalizer >= 4.0` removed `is_cjk_uncommon`; some releases of
+# pdfminer.six (pulled in by pdfplumber) still import it. We stub it in once
+# so the import chain succeeds even with the latest charset-normalizer.
+# Living here means it runs in the app and in every worker process alike.
+try:
+    import charset_normalizer.utils as _cnu
+    if not hasattr(_cnu, "is_cjk_uncommon"):
+        def _dummy_is_cjk_uncommon(cp: int) -> bool:
+            """
+            Return False for every code-point.
+            Stub for pdfminer.six compatibility with newer charset-normalizer.
+            """
+            return False
+        _cnu.is_cjk_uncommon = _dummy_is_cjk_uncommon
+except Exception:
+    # If charset_normalizer itself is missing, pdfplumber will raise later and
+    # we’ll surface that error; no further action needed here.
+    pass
+
+# ────────────────────────── Backend availability ──────────────────────────────
+# PDFium parses text natively — far faster than pdfminer for text-only output.
+# pdfplumber stays as the fallback for pages PDFium returns empty. Both are
+# imported lazily inside the functions below.
+PDFPLUMBER_AVAILABLE = importlib.util.find_spec("pdfplumber") is not None
+PDFIUM_AVAILABLE     = importlib.util.find_spec("pypdfium2") is not None
+# Goes into cache keys for extracted Markdown: bump the version whenever the
+# extraction output changes, so stale entries from another backend or an
+# older pipeline are not served.
+EXTRACTOR_TAG = ("pdfium" if PDFIUM_AVAILABLE else "pdfplumber") + "-v2"
+
+# PDFium is not thread-safe, and Streamlit runs each session in its own
+# thread. Every in-process PDFium call holds this lock, and callers hold it
+# while forking workers so no child inherits PDFium mid-call. A child forked
+# with the lock held would inherit it locked, so each child gets a fresh one.
+PDFIUM_LOCK = threading.Lock()
+
+def _reset_pdfium_lock() -> None:
+    global PDFIUM_LOCK
+    PDFIUM_LOCK = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pdfium_lock)
+
+class PdfplumberImportError(RuntimeError):
+    """
+    pdfplumber is installed but failed to import; the message is the repr of
+    the original error. Picklable, so it crosses the process pool intact.
+    """
+
+def _import_pdfplumber():
+    try:
+        import pdfplumber  # pulls in pdfminer.six -> charset_normalizer
+    except Exception as ex:  # catch *all* import problems
+        raise PdfplumberImportError(repr(ex)) from None
+    return pdfplumber
+
+# ────────────────────────── Extraction ────────────────────────────────────────
+def page_count(pdf_bytes: bytes) -> int:
+    """
+    Number of pages in the PDF, read with whichever backend is available.
+    """
+    if PDFIUM_AVAILABLE:
+        import pypdfium2 as pdfium
+        with PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+    pdfplumber = _import_pdfplumber()
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return len(pdf.pages)
+
+def extract_block(pdf_bytes: bytes, page_indices: List[int]) -> List[Tuple[int, str]]:
+    """
+    Extract the text of a block of pages (0-based indices), returning
+    (1-based page number, text) pairs. The PDF is opened once per block so
+    xref/font parsing is amortized over several pages.
+    """
+    texts = {}
+    if PDFIUM_AVAILABLE:
+        import pypdfium2 as pdfium
+        with PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                for page_idx in page_indices:
+                    page     = pdf[page_idx]
+                    textpage = page.get_textpage()
+                    # PDFium emits CRLF line breaks; normalize to match pdfplumber.
+                    texts[page_idx] = textpage.get_text_range().replace("\r\n", "\n")
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+
+    fallback = [i for i in page_indices if not texts.get(i, "").strip()]
+    if fallback and PDFPLUMBER_AVAILABLE:
+        pdfplumber = _import_pdfplumber()
+        # laparams=None keeps pdfminer's LAParams layout analysis (line/box
+        # grouping, vertical-text detection) switched off; pdfplumber
+        # clusters chars into lines itself, which is all extract_text needs.
+        with pdfplumber.open(
+            io.BytesIO(pdf_bytes), pages=[i + 1 for i in fallback],
+            laparams=None
+        ) as pdf:
+            for page_idx, p in zip(fallback, pdf.pages):
+                texts[page_idx] = p.extract_text() or ""
+                # close() flushes the cached objects/layout and the textmap
+                # cache too, so only one page's parse is alive at a time.
+                p.close()
+    return [(page_idx + 1, texts.get(page_idx, "")) for page_idx in page_indices]
+
+# ────────────────────────── Process-pool entry points ─────────────────────────
+# The PDF is handed to each worker once via the pool initializer; tasks then
+# carry only their page indices instead of re-pickling the whole document.
+_WORKER_PDF_BYTES: Optional[bytes] = None
+
+def init_worker(pdf_bytes: bytes) -> None:
+    """
+    ProcessPoolExecutor initializer: keep this worker's copy of the PDF.
+    """
+    global _WORKER_PDF_BYTES
+    _WORKER_PDF_BYTES = pdf_bytes
+
+def extract_worker_block(page_indices: List[int]) -> List[Tuple[int, str]]:
+    """
+    Pool task: extract_block() against the PDF passed to init_worker().
+    """
+    return extract_block(_WORKER_PDF_BYTES, page_indices)